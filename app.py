@@ -1,14 +1,15 @@
 import streamlit as st
-from PyPDF2 import PdfReader
+import fitz
 import pandas as pd
 import re
-import requests
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from medical_extractor import (
     extract_tests_from_page,
-    extract_patient_info
+    extract_patient_info,
+    generate_json
 )
 
 from medical_db import (
@@ -16,15 +17,59 @@ from medical_db import (
     get_or_create_patient,
     insert_report,
     insert_test_results,
-    get_connection
+    transaction,
+    get_connection,
+    get_db_mtime
 )
 
 # -------------------------
 # ollama config
 # -------------------------
-OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
 OLLAMA_MODEL = "mistral"
 MATCH_CONFIDENCE_THRESHOLD = 0.9
+MATCH_OPTIONS = {"num_ctx": 4096, "temperature": 0, "num_predict": 1024}
+# new tests per matcher call; ~30 output tokens each keeps well under num_predict
+MATCH_BATCH_SIZE = 15
+# concurrent page extraction calls, keep low for a single-gpu ollama
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", "4"))
+
+# -------------------------
+# precompiled patterns
+# -------------------------
+# one tokenizer for recover_ranges_from_text:
+# header   - every line start (zero-width); the line is checked with
+#            str.isupper() in python, and a rejected line is still
+#            scanned for values
+# range    - "a - b"
+# limit    - "upto x" / "< x" / "≤ x", unless it starts a range
+# unit     - known units
+# nl       - line boundary
+_PAGE_RE = re.compile(
+    r"^(?=(?P<header>[^\n]*))"
+    r"|(?P<range>\d+(?:\.\d+)?[^\S\n]*[-–][^\S\n]*\d+(?:\.\d+)?)"
+    r"|(?P<limit>(?P<op>upto|<|≤)[^\S\n]*(?P<num>\d+(?:\.\d+)?)"
+    r"(?!\d|\.\d|[^\S\n]*[-–][^\S\n]*\d))"
+    r"|(?P<unit>mg/dl|ug/dL|ng/ml|uIU/mL|Ratio)"
+    r"|(?P<nl>\n)",
+    re.I | re.M
+)
+
+# panel keywords in priority order: the first panel with a hit wins
+_PANEL_KEYWORDS = {
+    "thyroid": ["thyroid", "tsh", "t3", "t4"],
+    "lipid": ["cholesterol", "triglyceride", "hdl", "ldl", "vldl", "lipid"],
+    "liver": ["bilirubin", "liver"],
+}
+_PANEL_PRIORITY = {panel: i for i, panel in enumerate(_PANEL_KEYWORDS)}
+
+# one alternation over every keyword, a named group per panel; the
+# lookahead keeps matches zero-width so no hit can hide another
+_PANEL_RE = re.compile("(?=" + "|".join(
+    f"(?P<{panel}>{'|'.join(words)})"
+    for panel, words in _PANEL_KEYWORDS.items()
+) + ")")
+
+_HEADER_SKIP_RE = re.compile(r"METHOD|PROFILE")
 
 # -------------------------
 # page config
@@ -75,124 +120,168 @@ def classify_test_type(test_name: str, unit: str) -> str:
 
 
 def extract_panel(test_name: str) -> str:
-    n = test_name.lower()
-
-    if any(x in n for x in ["thyroid", "tsh", "t3", "t4"]):
-        return "thyroid"
-
-    if any(x in n for x in ["cholesterol", "triglyceride", "hdl", "ldl", "vldl", "lipid"]):
-        return "lipid"
+    hits = {m.lastgroup for m in _PANEL_RE.finditer(test_name.lower())}
 
-    if "bilirubin" in n or "liver" in n:
-        return "liver"
+    if not hits:
+        return "unknown"
 
-    return "unknown"
+    return min(hits, key=_PANEL_PRIORITY.__getitem__)
 
 
 def recover_ranges_from_text(page_text: str):
     recovered = {}
-    lines = [l.strip() for l in page_text.splitlines() if l.strip()]
     current_test = None
+    in_header = False
+    unit, value_range, limit = "", None, None
 
-    for line in lines:
-        if (
-            len(line) > 8
-            and line.isupper()
-            and not any(x in line for x in ["METHOD", "PROFILE"])
-        ):
-            current_test = line.lower()
-            continue
+    # same line boundaries as str.splitlines(), plus a trailing
+    # newline so the last line is flushed too
+    text = "\n".join(page_text.splitlines()) + "\n"
 
-        if not current_test:
-            continue
+    for m in _PAGE_RE.finditer(text):
+        kind = m.lastgroup
 
-        unit_match = re.search(
-            r"(mg/dl|mg/dL|ug/dL|ng/ml|uIU/mL|Ratio)",
-            line,
-            re.I
-        )
-        unit = unit_match.group(1).lower() if unit_match else ""
+        if kind == "nl":
+            if current_test and not in_header and (value_range or limit):
+                recovered[(current_test, unit)] = value_range or limit
+            in_header = False
+            unit, value_range, limit = "", None, None
 
-        m = re.search(r"(\d+(\.\d+)?)\s*[-–]\s*(\d+(\.\d+)?)", line)
-        if m:
-            recovered[(current_test, unit)] = m.group(0)
+        elif in_header:
             continue
 
-        limit = re.search(r"(upto|<|≤)\s*(\d+(\.\d+)?)", line, re.I)
-        if limit:
-            recovered[(current_test, unit)] = f"{limit.group(1)} {limit.group(2)}"
+        elif kind == "header":
+            header = m.group("header").strip()
+            if (
+                len(header) > 8
+                and header.isupper()
+                and not _HEADER_SKIP_RE.search(header)
+            ):
+                current_test = header.lower()
+                in_header = True
+
+        elif kind == "unit" and not unit:
+            unit = m.group("unit").lower()
+
+        elif kind == "range" and value_range is None:
+            value_range = m.group("range")
+
+        elif kind == "limit" and limit is None:
+            limit = f"{m.group('op')} {m.group('num')}"
 
     return recovered
 
 
-def get_existing_tests_for_patient(patient_name):
+@st.cache_data(show_spinner=False, max_entries=1)
+def get_patient_names(db_mtime):
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT name FROM patients ORDER BY name"
+    ).fetchall()
+    return [r[0] for r in rows if r[0]]
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def get_existing_tests(patient_name):
+    """
+    Existing test names of one patient, grouped for matching:
+    (type, panel, unit) -> [test names]
+    Cached per patient; cleared after every insert.
+    """
     conn = get_connection()
     rows = conn.execute("""
-        SELECT DISTINCT test_name, unit
+        SELECT DISTINCT t.test_name, t.unit
         FROM test_results t
         JOIN reports r ON t.report_id = r.report_id
         JOIN patients p ON r.patient_id = p.patient_id
         WHERE p.name = ?
     """, (patient_name,)).fetchall()
-    conn.close()
 
-    tests = []
+    existing = {}
     for name, unit in rows:
-        tests.append({
-            "name": name,
-            "unit": unit,
-            "type": classify_test_type(name, unit),
-            "panel": extract_panel(name)
-        })
-    return tests
-
-
-def ai_match_test_name(new_test, existing_tests):
-    if not existing_tests:
-        return None
+        unit = unit or ""
+        key = (classify_test_type(name, unit), extract_panel(name), unit.lower())
+        existing.setdefault(key, []).append(name)
+    return existing
 
-    candidates = "\n".join(f"- {t['name']}" for t in existing_tests)
 
-    prompt = f"""
-You are a medical lab test name matcher.
+# static matcher instructions, sent as the system message
+MATCH_RULES = """You are a medical lab test name matcher.
 
 Rules:
+- Match each NEW TEST against the EXISTING TESTS.
 - Match ONLY if it is the same lab test.
 - Ratios are NOT the same as base measurements.
 - If unsure, return no_match.
+- Return one entry per new test.
 - Output JSON only.
 
-NEW TEST:
-{new_test['name']}
+Output:
+{
+  "matches": [
+    {
+      "new": "<new test name>",
+      "match": "<existing test name or no_match>",
+      "confidence": 0.0
+    }
+  ]
+}
+"""
+
 
-EXISTING TESTS:
-{candidates}
+@st.cache_data(show_spinner=False)
+def _ai_match_batch(new_names: tuple, candidates: tuple) -> dict:
+    """
+    One LLM call for a whole group of new tests.
+    Raises on request / parse failure so failures are never cached.
+    """
+    new_list = "\n".join(f"- {n}" for n in new_names)
+    candidate_list = "\n".join(f"- {c}" for c in candidates)
 
-Output:
-{{
-  "match": "<existing test name or no_match>",
-  "confidence": 0.0
-}}
+    prompt = f"""NEW TESTS:
+{new_list}
+
+EXISTING TESTS:
+{candidate_list}
 """
 
-    try:
-        res = requests.post(
-            f"{OLLAMA_HOST}/api/generate",
-            json={"model": OLLAMA_MODEL, "prompt": prompt, "stream": False},
-            timeout=120
-        )
-        out = json.loads(res.json()["response"])
-    except Exception:
-        return None
+    out = json.loads(generate_json(
+        prompt,
+        model=OLLAMA_MODEL,
+        timeout=120,
+        system=MATCH_RULES,
+        options=MATCH_OPTIONS
+    ))
 
-    if (
-        out.get("match")
-        and out["match"] != "no_match"
-        and float(out.get("confidence", 0)) >= MATCH_CONFIDENCE_THRESHOLD
-    ):
-        return out["match"]
+    matches = {}
+    for m in out.get("matches", []):
+        if (
+            m.get("new") in new_names
+            and m.get("match") in candidates
+            and float(m.get("confidence", 0)) >= MATCH_CONFIDENCE_THRESHOLD
+        ):
+            matches[m["new"]] = m["match"]
+    return matches
+
+
+def ai_match_test_names(new_names, candidates):
+    """
+    Returns the matched existing name (or None) for each new name, in order.
+    """
+    if not new_names or not candidates:
+        return [None] * len(new_names)
+
+    # large groups are split so the response is never cut off;
+    # a failed chunk only loses its own matches
+    matches = {}
+    for start in range(0, len(new_names), MATCH_BATCH_SIZE):
+        chunk = tuple(new_names[start:start + MATCH_BATCH_SIZE])
+        try:
+            matches.update(_ai_match_batch(chunk, tuple(candidates)))
+        except Exception:
+            continue
 
-    return None
+    return [matches.get(n) for n in new_names]
 
 # -------------------------
 # upload section
@@ -202,12 +291,19 @@ st.header("upload medical report")
 uploaded = st.file_uploader("upload pdf medical report", type=["pdf"])
 
 if uploaded:
-    reader = PdfReader(uploaded)
+    # parse the pdf once per upload, reruns reuse the cached page text
+    upload_key = uploaded.file_id
+    if st.session_state.get("pages_key") != upload_key:
+        doc = fitz.open(stream=uploaded.getvalue(), filetype="pdf")
+        st.session_state["pages_text"] = [p.get_text("text") for p in doc]
+        st.session_state["pages_key"] = upload_key
+        st.session_state.pop("full_text", None)
+        doc.close()
+
+    pages_text = st.session_state["pages_text"]
 
     if st.button("read this document"):
-        st.session_state["full_text"] = "\n".join(
-            page.extract_text() or "" for page in reader.pages
-        )
+        st.session_state["full_text"] = "\n".join(pages_text)
 
     full_text = st.session_state.get("full_text")
 
@@ -216,65 +312,68 @@ if uploaded:
 
     if st.button("add this document to records"):
         with st.spinner("processing medical report…"):
-            patient_info = extract_patient_info(full_text)
+            patient_info = extract_patient_info(full_text or "\n".join(pages_text))
 
             if not patient_info.get("patient_name"):
                 st.error("could not detect patient name from report")
                 st.stop()
 
-            patient_id = get_or_create_patient(patient_info["patient_name"])
-
-
-            report_id = insert_report(patient_id, patient_info.get("report_date"), uploaded.name)
-
             all_tests = []
             range_cache = {}
 
-            for page in reader.pages:
-                text = page.extract_text()
-                if not text:
-                    continue
+            pages = [text for text in pages_text if text.strip()]
 
-                page_tests = extract_tests_from_page(text)
+            with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as ex:
+                page_results = list(ex.map(extract_tests_from_page, pages))
+
+            for text, page_tests in zip(pages, page_results):
                 recovered = recover_ranges_from_text(text)
 
+                # key is computed once and kept on the test for the backfill
                 for t in page_tests:
-                    key = ((t["test_name"] or "").lower(), (t.get("unit") or "").lower())
-                    if t.get("reference_range"):
-                        range_cache[key] = t["reference_range"]
-                    elif key in recovered:
-                        range_cache[key] = recovered[key]
+                    key = ((t.get("test_name") or "").lower(), (t.get("unit") or "").lower())
+                    t["_key"] = key
+                    rng = t.get("reference_range") or recovered.get(key)
+                    if rng:
+                        range_cache[key] = rng
 
-                all_tests.extend(page_tests or [])
+                all_tests.extend(page_tests)
 
             for t in all_tests:
-                key = ((t["test_name"] or "").lower(), (t.get("unit") or "").lower())
-                if not t.get("reference_range") and key in range_cache:
-                    t["reference_range"] = range_cache[key]
+                if not t.get("reference_range"):
+                    t["reference_range"] = range_cache.get(t["_key"], "")
 
             # -------- AI identity resolution --------
-            existing_tests = get_existing_tests_for_patient(patient_info["patient_name"])
+            existing_tests = get_existing_tests(patient_info["patient_name"])
 
-            for t in all_tests:
-                new_test = {
-                    "name": t["test_name"],
-                    "unit": t.get("unit", ""),
-                    "type": classify_test_type(t["test_name"], t.get("unit", "")),
-                    "panel": extract_panel(t["test_name"])
-                }
-
-                candidates = [
-                    et for et in existing_tests
-                    if et["type"] == new_test["type"]
-                    and et["panel"] == new_test["panel"]
-                    and et["unit"].lower() == new_test["unit"].lower()
-                ]
-
-                matched = ai_match_test_name(new_test, candidates)
-                if matched:
-                    t["test_name"] = matched
-
-            insert_test_results(report_id, all_tests)
+            # group new tests by (type, panel, unit) so each group
+            # is resolved with a single LLM call
+            groups = {}
+            for i, t in enumerate(all_tests):
+                name = t.get("test_name") or ""
+                unit = t.get("unit") or ""
+                key = (classify_test_type(name, unit), extract_panel(name), unit.lower())
+                groups.setdefault(key, []).append(i)
+
+            for (test_type, panel, unit), idxs in groups.items():
+                candidates = existing_tests.get((test_type, panel, unit), [])
+
+                new_names = [all_tests[i]["test_name"] for i in idxs]
+                matches = ai_match_test_names(new_names, candidates)
+
+                for i, matched in zip(idxs, matches):
+                    if matched:
+                        all_tests[i]["test_name"] = matched
+
+            # patient, report and results are written together so a
+            # failed extraction or insert leaves no empty report behind
+            with transaction() as cur:
+                patient_id = get_or_create_patient(patient_info["patient_name"], cur)
+                report_id = insert_report(patient_id, patient_info.get("report_date"), uploaded.name, cur)
+                insert_test_results(report_id, all_tests, cur)
+
+            get_patient_names.clear()
+            get_existing_tests.clear()
 
         st.success("medical report added successfully")
 
@@ -285,13 +384,7 @@ st.header("view patient records")
 # -------------------------
 # patient selector
 # -------------------------
-conn = get_connection()
-patients = conn.execute(
-    "SELECT name FROM patients ORDER BY name"
-).fetchall()
-conn.close()
-
-patient_names = [p[0] for p in patients if p[0]]
+patient_names = get_patient_names(get_db_mtime())
 
 if not patient_names:
     st.info("no patients found yet")
@@ -318,7 +411,6 @@ if selected_patient:
         WHERE lower(p.name) = ?
         ORDER BY r.report_date ASC
     """, (selected_patient.lower(),)).fetchall()
-    conn.close()
 
     if not rows:
         st.warning("no test results found for this patient")
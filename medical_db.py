@@ -1,10 +1,44 @@
+import contextlib
+import functools
+import os
 import sqlite3
+import threading
 
 DB_PATH = "medical_records.db"
 
 
+# one connection per thread: streamlit runs every session on its own
+# script thread, and explicit BEGIN ... COMMIT blocks must not be joined
+# by statements from another session
+_local = threading.local()
+
+
 def get_connection():
-    return sqlite3.connect(DB_PATH)
+    """
+    Shared connection for the calling thread.
+    Autocommit mode, transactions are opened explicitly where needed.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        _local.conn = conn
+    return conn
+
+
+def get_db_mtime():
+    """
+    Last write time of the database, WAL file included.
+    Used as a cache key by read helpers.
+    """
+    paths = [DB_PATH, f"{DB_PATH}-wal"]
+    return max(
+        (os.path.getmtime(p) for p in paths if os.path.exists(p)),
+        default=0.0
+    )
 
 
 def init_db():
@@ -44,11 +78,19 @@ def init_db():
         value TEXT,
         unit TEXT,
         normal_range TEXT,
+        value_num REAL,
+        low_num REAL,
+        high_num REAL,
         FOREIGN KEY(report_id) REFERENCES reports(report_id),
         FOREIGN KEY(canonical_id) REFERENCES canonical_tests(canonical_id)
     )
     """)
 
+    # numeric columns for older databases
+    columns = {r[1] for r in cur.execute("PRAGMA table_info(test_results)")}
+    if "value_num" not in columns:
+        backfill_numeric_columns(cur)
+
     # -------------------------
     # canonical test registry
     # -------------------------
@@ -74,40 +116,79 @@ def init_db():
     )
     """)
 
-    conn.commit()
-    conn.close()
+    # -------------------------
+    # join indexes
+    # patients.name and test_explanations are already
+    # covered by their UNIQUE / PRIMARY KEY indexes
+    # -------------------------
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tr_report
+    ON test_results(report_id)
+    """)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_r_patient
+    ON reports(patient_id)
+    """)
+
+    # partial index over abnormal results only, so the problems
+    # query never touches in-range history
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tr_abnormal
+    ON test_results(report_id)
+    WHERE value_num < low_num OR value_num > high_num
+    """)
+
+    # older sqlite's optimize never analyzes a table without stats,
+    # so seed them once there is data worth measuring
+    has_stats = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+    ).fetchone()
+    has_results = cur.execute("SELECT 1 FROM test_results LIMIT 1").fetchone()
+    if not has_stats and has_results:
+        cur.execute("ANALYZE")
+
+    # refresh stats that have gone stale since the last start;
+    # 0x10000 makes sqlite 3.46+ check every table
+    cur.execute("PRAGMA optimize=0x10002")
 
 
 # -------------------------
 # patients & reports
 # -------------------------
-def get_or_create_patient(name):
-    conn = get_connection()
-    cur = conn.cursor()
+@contextlib.contextmanager
+def transaction():
+    """
+    Yield a cursor inside BEGIN ... COMMIT, rolled back if the block raises.
+    Helpers given this cursor run inside the same transaction.
+    """
+    cur = get_connection().cursor()
 
-    cur.execute(
-        "SELECT patient_id FROM patients WHERE name = ?",
-        (name,)
-    )
-    row = cur.fetchone()
+    cur.execute("BEGIN")
+    try:
+        yield cur
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
 
-    if row:
-        patient_id = row[0]
-    else:
-        cur.execute(
-            "INSERT INTO patients (name) VALUES (?)",
-            (name,)
-        )
-        patient_id = cur.lastrowid
+    cur.execute("COMMIT")
 
-    conn.commit()
-    conn.close()
-    return patient_id
 
+def get_or_create_patient(name, cur=None):
+    cur = cur or get_connection().cursor()
 
-def insert_report(patient_id, report_date, source_file):
-    conn = get_connection()
-    cur = conn.cursor()
+    # no-op update on conflict so RETURNING also yields existing rows
+    row = cur.execute("""
+    INSERT INTO patients (name) VALUES (?)
+    ON CONFLICT(name) DO UPDATE SET name = excluded.name
+    RETURNING patient_id
+    """, (name,)).fetchone()
+
+    return row[0]
+
+
+def insert_report(patient_id, report_date, source_file, cur=None):
+    cur = cur or get_connection().cursor()
 
     cur.execute("""
     INSERT INTO reports (patient_id, report_date, source_file)
@@ -115,26 +196,89 @@ def insert_report(patient_id, report_date, source_file):
     """, (patient_id, report_date, source_file))
 
     report_id = cur.lastrowid
-    conn.commit()
-    conn.close()
     return report_id
 
 
 # -------------------------
-# test results
+# numeric parsing
+# parsed once at insert time so abnormal values
+# can be filtered in SQL
 # -------------------------
-def insert_test_results(report_id, tests):
-    conn = get_connection()
-    cur = conn.cursor()
+def parse_value(value):
+    if value is None:
+        return None
+    try:
+        return float(str(value).replace("H", "").replace("L", "").strip())
+    except ValueError:
+        return None
+
+
+def parse_range_bounds(normal_range):
+    """
+    (low, high) numeric bounds of a reference range, either may be None.
+    """
+    if not normal_range:
+        return None, None
+
+    rng = normal_range.lower().replace(" ", "")
+
+    try:
+        if "-" in rng:
+            low, high = rng.split("-")
+            return float(low), float(high)
+
+        if "upto" in rng or rng.startswith("<"):
+            return None, float(rng.replace("upto", "").replace("<", ""))
+
+        if "morethan" in rng or rng.startswith(">"):
+            return float(rng.replace("morethan", "").replace(">", "")), None
+
+    except ValueError:
+        pass
+
+    return None, None
+
+
+def backfill_numeric_columns(cur):
+    """
+    Add value_num / low_num / high_num to an existing test_results
+    table and fill them from the stored text values.
+    """
+    cur.execute("BEGIN")
+    try:
+        for col in ["value_num", "low_num", "high_num"]:
+            cur.execute(f"ALTER TABLE test_results ADD COLUMN {col} REAL")
+
+        rows = cur.execute(
+            "SELECT result_id, value, normal_range FROM test_results"
+        ).fetchall()
+
+        cur.executemany("""
+        UPDATE test_results
+        SET value_num = ?, low_num = ?, high_num = ?
+        WHERE result_id = ?
+        """, [
+            (parse_value(value), *parse_range_bounds(rng), result_id)
+            for result_id, value, rng in rows
+        ])
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+    cur.execute("COMMIT")
 
-    for t in tests:
-        canonical_id = t.get("canonical_id")
 
-        test_name = (t.get("test_name") or "").strip().lower()
-        test_context = (t.get("test_context") or "").strip().lower()
+# -------------------------
+# test results
+# -------------------------
+def insert_test_results(report_id, tests, cur=None):
+    rows = []
+    for t in tests:
+        test_name = str(t.get("test_name") or "").strip().lower()
+        test_context = str(t.get("test_context") or "").strip().lower()
         value = str(t.get("value") or "").strip()
         unit = str(t.get("unit") or "").strip()
-        normal_range = (
+        normal_range = str(
             t.get("reference_range")
             or t.get("normal_range")
             or ""
@@ -143,22 +287,35 @@ def insert_test_results(report_id, tests):
         if not test_name or not value:
             continue
 
-        cur.execute("""
-        INSERT INTO test_results
-        (report_id, canonical_id, test_name, test_context, value, unit, normal_range)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
+        rows.append((
             report_id,
-            canonical_id,
+            t.get("canonical_id"),
             test_name,
             test_context,
             value,
             unit,
-            normal_range
+            normal_range,
+            parse_value(value),
+            *parse_range_bounds(normal_range)
         ))
 
-    conn.commit()
-    conn.close()
+    if not rows:
+        return
+
+    if cur is None:
+        with transaction() as cur:
+            _insert_result_rows(cur, rows)
+    else:
+        _insert_result_rows(cur, rows)
+
+
+def _insert_result_rows(cur, rows):
+    cur.executemany("""
+    INSERT INTO test_results
+    (report_id, canonical_id, test_name, test_context, value, unit,
+     normal_range, value_num, low_num, high_num)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
 
 
 # -------------------------
@@ -167,17 +324,19 @@ def insert_test_results(report_id, tests):
 def upsert_canonical_test(canonical_id, canonical_name, unit=None, panel=None):
     conn = get_connection()
     conn.execute("""
-        INSERT OR REPLACE INTO canonical_tests
+        INSERT INTO canonical_tests
         (canonical_id, canonical_name, unit, panel)
         VALUES (?, ?, ?, ?)
+        ON CONFLICT(canonical_id) DO UPDATE SET
+            canonical_name = excluded.canonical_name,
+            unit = excluded.unit,
+            panel = excluded.panel
     """, (
         canonical_id,
         canonical_name,
         unit,
         panel
     ))
-    conn.commit()
-    conn.close()
 
 
 def get_all_canonical_tests():
@@ -186,7 +345,6 @@ def get_all_canonical_tests():
         SELECT canonical_id, canonical_name, unit, panel
         FROM canonical_tests
     """).fetchall()
-    conn.close()
     return rows
 
 
@@ -206,10 +364,18 @@ def get_test_explanation(test_name, test_context, abnormal_type):
         test_context.lower(),
         abnormal_type
     )).fetchone()
-    conn.close()
     return row[0] if row else None
 
 
+@functools.lru_cache(maxsize=512)
+def get_cached_test_explanation(test_name, test_context, abnormal_type):
+    """
+    In-process memo over get_test_explanation.
+    Cleared whenever explanations are saved or deleted.
+    """
+    return get_test_explanation(test_name, test_context, abnormal_type)
+
+
 def save_test_explanation(test_name, test_context, abnormal_type, explanation):
     conn = get_connection()
     conn.execute("""
@@ -222,13 +388,11 @@ def save_test_explanation(test_name, test_context, abnormal_type, explanation):
         abnormal_type,
         explanation
     ))
-    conn.commit()
-    conn.close()
+    get_cached_test_explanation.cache_clear()
 
 
 def clear_test_explanations():
     conn = get_connection()
     conn.execute("DELETE FROM test_explanations")
-    conn.commit()
-    conn.close()
+    get_cached_test_explanation.cache_clear()
 #
\ No newline at end of file
@@ -3,8 +3,126 @@ import requests
 import os
 import re
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
 MODEL = "mistral"   # fast + good at structured extraction
+MAX_RETRIES = 3
+
+# one keep-alive session for every ollama call; retries connection
+# errors and transient 5xx/429 with exponential backoff. read=0 so a
+# generation that timed out mid-stream is never sent again
+_SESSION = requests.Session()
+_SESSION.mount(OLLAMA_HOST, HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=MAX_RETRIES,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None
+    )
+))
+
+
+# -------------------------
+# ollama streaming
+# -------------------------
+def stream_chat(
+    prompt: str,
+    model: str = MODEL,
+    timeout: int = 300,
+    system: str | None = None,
+    options: dict | None = None,
+    response_format: str | None = None
+):
+    """
+    Yield response text chunks from ollama /api/chat as they are generated.
+    Connecting is retried by the session adapter; once chunks start
+    arriving the stream is not restarted.
+    response_format="json" constrains the model to valid JSON.
+    """
+    messages = []
+    if system:
+        messages.append({"role": "system", "content": system})
+    messages.append({"role": "user", "content": prompt})
+
+    body = {
+        "model": model,
+        "messages": messages,
+        "stream": True
+    }
+    if options:
+        body["options"] = options
+    if response_format:
+        body["format"] = response_format
+
+    res = _SESSION.post(
+        f"{OLLAMA_HOST}/api/chat",
+        json=body,
+        stream=True,
+        timeout=timeout
+    )
+
+    # close the streamed response (and release its pooled
+    # connection) on http errors too
+    with res:
+        res.raise_for_status()
+        for line in res.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            yield chunk.get("message", {}).get("content", "")
+            if chunk.get("done"):
+                break
+
+
+def generate_json(
+    prompt: str,
+    model: str = MODEL,
+    timeout: int = 300,
+    system: str | None = None,
+    options: dict | None = None
+) -> str:
+    """
+    Collect a JSON-mode streamed response and stop as soon as the top-level
+    JSON object / array closes, dropping anything the model adds after it.
+    """
+    buf = []
+    depth = 0
+    in_string = False
+    escaped = False
+
+    for chunk in stream_chat(
+        prompt,
+        model=model,
+        timeout=timeout,
+        system=system,
+        options=options,
+        response_format="json"
+    ):
+        for i, ch in enumerate(chunk):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch in "{[":
+                depth += 1
+            elif ch in "}]" and depth:
+                depth -= 1
+                if depth == 0:
+                    buf.append(chunk[:i + 1])
+                    return "".join(buf).strip()
+        buf.append(chunk)
+
+    return "".join(buf).strip()
 
 
 # -------------------------
@@ -25,14 +143,9 @@ def normalize_test_name(name: str) -> str:
 # -------------------------
 # test extraction
 # -------------------------
-def extract_tests_from_page(page_text: str) -> list[dict]:
-    """
-    Extract clinically reported test results from ONE PAGE of a medical report.
-    Returns a list of tests. If no tests found, returns empty list.
-    """
-
-    prompt = f"""
-You are a medical laboratory report parser.
+# static instructions sent as the system message, kept byte-identical
+# across calls so ollama can reuse the cached prompt prefix
+EXTRACT_RULES = """You are a medical laboratory report parser.
 
 You will be given the text of ONE PAGE of a medical lab report.
 
@@ -79,51 +192,155 @@ Additional clarification:
 - Do NOT exclude a test solely because it appears at the end of a section.
 
 Output format:
-{{
+{
   "tests": [
-    {{
+    {
       "test_name": "",
       "test_context": "",
       "value": "",
       "unit": "",
       "reference_range": ""
-    }}
+    }
   ]
-}}
-
-Page text:
-{page_text}
+}
 """
 
-    try:
-        res = requests.post(
-            f"{OLLAMA_HOST}/api/generate",
-            json={
-                "model": MODEL,
-                "prompt": prompt,
-                "stream": False
-            },
-            timeout=300
-        )
-    except requests.exceptions.RequestException:
-        return []
+# num_predict bounds the output; a dense page of ~40 results fits well under it
+EXTRACT_OPTIONS = {"num_ctx": 4096, "temperature": 0, "num_predict": 2048}
 
-    raw = res.json().get("response", "").strip()
 
-    try:
-        parsed = json.loads(raw)
-        tests = parsed.get("tests", [])
+# deterministic pass for regular "NAME  VALUE  [H/L]  UNIT  RANGE" rows,
+# matched against one whole (stripped) line at a time
+_QUALITATIVE = r"non[ -]?reactive|reactive|negative|positive|absent|present|nil|trace"
+_UNIT = r"%|ratio|fl|pg|[a-zµμ0-9^]*[a-zµμ]/[a-zµμ0-9^.]+"
+_RANGE = (
+    r"\d+(?:\.\d+)?\s*[-–]\s*\d+(?:\.\d+)?"
+    r"|(?:upto|up to|<|>|more than)\s*\d+(?:\.\d+)?"
+)
+# name words start with a letter, so a value can never sit inside the name
+_NAME_WORD = r"[A-Za-z(&][A-Za-z0-9/,()&-]*"
+_ROW_RE = re.compile(
+    rf"(?P<name>[A-Za-z][A-Za-z0-9/,()&-]*(?:[ \t]+{_NAME_WORD})*?)\s+"
+    rf"(?P<value>\d+(?:\.\d+)?|{_QUALITATIVE})"
+    r"(?:\s+[HL])?"
+    rf"(?:\s+(?P<unit>{_UNIT}))?"
+    rf"(?:\s*(?P<range>{_RANGE})(?:\s*(?P<range_unit>{_UNIT}))?)?",
+    re.I
+)
+# lines that carry a result and must be covered by _ROW_RE
+_RESULT_LINE_RE = re.compile(rf"\d|\b(?:{_QUALITATIVE})\b", re.I)
+# all-caps section heading, used as test_context
+_HEADING_RE = re.compile(r"[A-Z][A-Z ,()/&-]{3,}")
+
+# pages with fewer regex rows than this go to the LLM
+REGEX_MIN_ROWS = 3
 
-        # light normalization only
-        for t in tests:
-            if t.get("test_name"):
-                t["test_name"] = normalize_test_name(t["test_name"])
 
+def extract_tests_with_regex(page_text: str) -> list[dict] | None:
+    """
+    Cheap row matcher for well-structured pages.
+    Returns None unless every line with a number or a qualitative result
+    is a recognized row, so nothing is silently dropped without the LLM.
+    A numeric value only counts as a row when it has a unit.
+    """
+    tests = []
+    context = ""
+
+    for line in page_text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        # result lines first: all-caps rows like "HBSAG NEGATIVE"
+        # would otherwise be taken for headings
+        if not _RESULT_LINE_RE.search(line):
+            if _HEADING_RE.fullmatch(line):
+                context = line
+            continue
+
+        m = _ROW_RE.fullmatch(line)
+        if not m or len(m.group("name")) > 40:
+            return None
+
+        value = m.group("value")
+        unit = m.group("unit") or m.group("range_unit") or ""
+        if value[0].isdigit() and not unit:
+            return None
+
+        tests.append({
+            "test_name": normalize_test_name(m.group("name")),
+            "test_context": context,
+            "value": value,
+            "unit": unit,
+            "reference_range": m.group("range") or ""
+        })
+
+    return tests
+
+
+_TEST_FIELDS = ("test_context", "value", "unit", "reference_range")
+
+
+def _clean_test(t):
+    """
+    The model's item with every field as a string, or None when it
+    cannot be a row (not an object, no name, nested values).
+    """
+    if not isinstance(t, dict):
+        return None
+
+    name = t.get("test_name")
+    if not isinstance(name, str) or not name.strip():
+        return None
+
+    clean = dict(t, test_name=name)
+    for field in _TEST_FIELDS:
+        v = t.get(field)
+        if v is None:
+            clean[field] = ""
+        elif isinstance(v, (str, int, float)):
+            clean[field] = str(v)
+        else:
+            return None
+    return clean
+
+
+def extract_tests_from_page(page_text: str) -> list[dict]:
+    """
+    Extract clinically reported test results from ONE PAGE of a medical report.
+    Returns a list of tests. If no tests found, returns empty list.
+    """
+
+    tests = extract_tests_with_regex(page_text)
+    if tests is not None and len(tests) >= REGEX_MIN_ROWS:
         return tests
-    except Exception:
+
+    try:
+        raw = generate_json(
+            page_text,
+            system=EXTRACT_RULES,
+            options=EXTRACT_OPTIONS,
+            timeout=300
+        )
+        parsed = json.loads(raw)
+    except (requests.exceptions.RequestException, ValueError):
         # fail safely, never crash the app
         return []
 
+    # json mode guarantees valid json, not this schema
+    if not isinstance(parsed, dict):
+        return []
+    tests = parsed.get("tests")
+    if not isinstance(tests, list):
+        return []
+    tests = [clean for clean in map(_clean_test, tests) if clean]
+
+    # light normalization only
+    for t in tests:
+        t["test_name"] = normalize_test_name(t["test_name"])
+
+    return tests
+
 
 # -------------------------
 # patient info extraction
@@ -1,102 +1,54 @@
+import html
+
 import streamlit as st
-import sqlite3
-import requests
-import os
 
 from medical_db import (
-    get_test_explanation,
+    get_connection,
+    get_db_mtime,
+    get_cached_test_explanation,
     save_test_explanation,
     clear_test_explanations
 )
+from medical_extractor import stream_chat
 
 # -------------------------
 # config
 # -------------------------
-DB_PATH = "medical_records.db"
-OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
 MODEL = "llama3"
 
 # -------------------------
 # helpers
 # -------------------------
-def get_connection():
-    return sqlite3.connect(DB_PATH)
-
-
-def get_patients():
+@st.cache_data(show_spinner=False, max_entries=1)
+def get_patients(db_mtime):
     conn = get_connection()
     rows = conn.execute("SELECT name FROM patients").fetchall()
-    conn.close()
     return [r[0] for r in rows]
 
 
-def parse_value(value):
-    if value is None:
-        return None
-    try:
-        return float(str(value).replace("H", "").replace("L", "").strip())
-    except Exception:
-        return None
-
-
-def get_abnormal_type(raw_value, normal_range):
-    value = parse_value(raw_value)
-    if value is None or not normal_range:
-        return None
-
-    try:
-        rng = normal_range.lower().replace(" ", "")
-
-        if "-" in rng:
-            low, high = rng.split("-")
-            if value < float(low):
-                return "low"
-            if value > float(high):
-                return "high"
-
-        if "upto" in rng or rng.startswith("<"):
-            limit = float(rng.replace("upto", "").replace("<", ""))
-            if value > limit:
-                return "high"
-
-        if "morethan" in rng or rng.startswith(">"):
-            limit = float(rng.replace("morethan", "").replace(">", ""))
-            if value < limit:
-                return "low"
-
-    except Exception:
-        return None
-
-    return None
-
-
 def get_problem_tests(patient_name):
+    # value_num / low_num / high_num are parsed at insert time,
+    # so only abnormal rows leave the database
     conn = get_connection()
-    rows = conn.execute("""
+    return conn.execute("""
         SELECT
             t.test_name,
             t.test_context,
             t.value,
             t.unit,
             t.normal_range,
-            r.report_date
+            r.report_date,
+            CASE
+                WHEN t.value_num < t.low_num THEN 'low'
+                ELSE 'high'
+            END AS abnormal_type
         FROM test_results t
         JOIN reports r ON t.report_id = r.report_id
         JOIN patients p ON r.patient_id = p.patient_id
         WHERE p.name = ?
+          AND (t.value_num < t.low_num OR t.value_num > t.high_num)
         ORDER BY r.report_date DESC
     """, (patient_name,)).fetchall()
-    conn.close()
-
-    problems = []
-    for test, context, value, unit, rng, date in rows:
-        abnormal_type = get_abnormal_type(value, rng)
-        if abnormal_type:
-            problems.append(
-                (test, context, value, unit, rng, date, abnormal_type)
-            )
-
-    return problems
 
 
 # -------------------------
@@ -125,17 +77,37 @@ Format exactly:
 - 1 short bullet if relevant
 """
 
-    res = requests.post(
-        f"{OLLAMA_HOST}/api/generate",
-        json={
-            "model": MODEL,
-            "prompt": prompt,
-            "stream": False
-        },
-        timeout=120
+    yield from stream_chat(prompt, model=MODEL, timeout=120)
+
+
+# -------------------------
+# card html
+# -------------------------
+def card_html(idx, display_name, abnormal_type, value, unit, rng, date):
+    # single-line html, so several cards can share one st.markdown call
+    return (
+        '<div style="border:1px solid #ddd;border-radius:10px;'
+        'padding:14px;margin-bottom:14px;background-color:#fafafa;">'
+        f"<h4>Issue {idx+1}</h4>"
+        f"<b>Test:</b> {display_name}<br>"
+        f"<b>Issue:</b> {abnormal_type}<br>"
+        f"<b>Your value:</b> {value} {unit}<br>"
+        f"<b>Expected range:</b> {rng}<br>"
+        f"<b>Report date:</b> {date}"
+        "</div>"
     )
 
-    return res.json().get("response", "").strip()
+
+def explanation_html(explanation):
+    # blank lines around the body end the html block, so the
+    # explanation is rendered as markdown like st.write did
+    body = html.escape(explanation.strip(), quote=False)
+    return (
+        '<details style="margin-bottom:14px;">'
+        "<summary>understanding this finding</summary>"
+        f"\n\n{body}\n\n"
+        "</details>"
+    )
 
 
 # -------------------------
@@ -150,7 +122,7 @@ if st.button("reset ai explanations"):
     st.rerun()
 
 
-patients = get_patients()
+patients = get_patients(get_db_mtime())
 
 if not patients:
     st.info("no patient data found. upload a report first.")
@@ -168,54 +140,52 @@ st.subheader(f"issues found: {len(problems)}")
 
 cols = st.columns(2)
 
+# cards are batched per column and emitted with one st.markdown call;
+# a column is only flushed early when a card needs its generate button
+pending = [[], []]
+
 for idx, (test, context, value, unit, rng, date, abnormal_type) in enumerate(problems):
     display_name = f"{test} ({context})" if context else test
+    col = idx % 2
 
-    with cols[idx % 2]:
-        st.markdown(
-            f"""
-            <div style="
-                border:1px solid #ddd;
-                border-radius:10px;
-                padding:14px;
-                margin-bottom:14px;
-                background-color:#fafafa;
-            ">
-                <h4>Issue {idx+1}</h4>
-                <b>Test:</b> {display_name}<br>
-                <b>Issue:</b> {abnormal_type}<br>
-                <b>Your value:</b> {value} {unit}<br>
-                <b>Expected range:</b> {rng}<br>
-                <b>Report date:</b> {date}
-            </div>
-            """,
-            unsafe_allow_html=True
-        )
+    pending[col].append(
+        card_html(idx, display_name, abnormal_type, value, unit, rng, date)
+    )
 
+    explanation = get_cached_test_explanation(
+        test,
+        context,
+        abnormal_type
+    )
+
+    if explanation:
+        pending[col].append(explanation_html(explanation))
+        continue
+
+    cols[col].markdown("\n".join(pending[col]), unsafe_allow_html=True)
+    pending[col] = []
+
+    with cols[col]:
         with st.expander("understanding this finding"):
-            explanation = get_test_explanation(
-                test,
-                context,
-                abnormal_type
-            )
-
-            if explanation:
-                st.write(explanation)
-            else:
-                if st.button(
-                    f"generate explanation for {display_name}",
-                    key=f"explain-{idx}"
-                ):
-                    with st.spinner("generating explanation…"):
-                        explanation = generate_test_explanation(
+            if st.button(
+                f"generate explanation for {display_name}",
+                key=f"explain-{idx}"
+            ):
+                with st.spinner("generating explanation…"):
+                    explanation = st.write_stream(
+                        generate_test_explanation(
                             test,
                             context,
                             abnormal_type
                         )
-                        save_test_explanation(
-                            test,
-                            context,
-                            abnormal_type,
-                            explanation
-                        )
-                    st.write(explanation)
+                    )
+                    save_test_explanation(
+                        test,
+                        context,
+                        abnormal_type,
+                        explanation.strip()
+                    )
+
+for col, blocks in enumerate(pending):
+    if blocks:
+        cols[col].markdown("\n".join(blocks), unsafe_allow_html=True)